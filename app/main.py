@@ -1,17 +1,35 @@
 import os
-import base64
-from io import BytesIO
+import asyncio
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, File, UploadFile, Form, HTTPException
 from fastapi.responses import HTMLResponse, PlainTextResponse, JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from PIL import Image
 from dotenv import load_dotenv
-from app.services.ocr_service import OCRService
+from app.services.ocr_service import OCRService, encode_image_base64
 
 # Load environment variables
 load_dotenv()
 
-app = FastAPI(title="DeepSeek OCR Web App")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Size the image-work thread pool, then prewarm Ollama in the background."""
+    # PIL decode/encode and drawing run in the loop's default executor so
+    # they don't block other requests on the event loop thread
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1))
+    )
+    # Don't hold up startup on a cold model load or an unreachable Ollama;
+    # keep a reference so the task isn't garbage collected mid-flight
+    warmup_task = asyncio.create_task(ocr_service.warmup())
+    yield
+    warmup_task.cancel()
+
+
+app = FastAPI(title="DeepSeek OCR Web App", lifespan=lifespan)
 
 # Add CORS middleware for local development
 app.add_middleware(
@@ -25,12 +43,29 @@ app.add_middleware(
 # Initialize OCR service
 ocr_service = OCRService()
 
+# Read the UI once at startup instead of from disk on every page load
+with open(os.path.join(os.path.dirname(__file__), "templates", "index.html"), "r") as f:
+    _INDEX_HTML = f.read()
+
+
+def _hash_upload(fp) -> str:
+    """Hash the raw upload bytes to key the OCR result cache."""
+    fp.seek(0)
+    return hashlib.file_digest(fp, lambda: hashlib.blake2b(digest_size=16)).hexdigest()
+
+
+def _open_image(fp) -> Image.Image:
+    """Open and fully decode an image from a file object."""
+    fp.seek(0)
+    image = Image.open(fp)
+    image.load()  # Force image to load fully
+    return image
+
 
 @app.get("/", response_class=HTMLResponse)
 async def read_root():
     """Serve the HTML UI."""
-    with open("app/templates/index.html", "r") as f:
-        return HTMLResponse(content=f.read())
+    return HTMLResponse(content=_INDEX_HTML, headers={"Cache-Control": "public, max-age=60"})
 
 
 @app.post("/api/ocr")
@@ -48,6 +83,8 @@ async def process_ocr(
     Returns:
         JSON with text result and annotated image (if detections found)
     """
+    image = None
+    annotated_image = None
     try:
         # Validate file type
         if not file.content_type or not file.content_type.startswith("image/"):
@@ -57,16 +94,24 @@ async def process_ocr(
         if not operation or not operation.strip():
             raise HTTPException(status_code=400, detail="Operation is required")
         
-        # Read and open image
-        image_data = await file.read()
-        image = Image.open(BytesIO(image_data))
+        loop = asyncio.get_running_loop()
+        
+        # Hash the raw upload bytes to key the OCR result cache; cheaper than
+        # hashing decoded pixels and just as unique
+        image_digest = await loop.run_in_executor(None, _hash_upload, file.file)
         
-        # Ensure image is loaded and get its size
-        image.load()  # Force image to load fully
-        print(f"[DEBUG] Original image size: {image.size}, mode: {image.mode}")
+        # Open image straight from the spooled upload; Starlette has already
+        # streamed the multipart body into a SpooledTemporaryFile, so there is
+        # no need to copy the whole payload into memory with file.read()
+        image = await loop.run_in_executor(None, _open_image, file.file)
+        # Decoded pixels no longer need the compressed upload, so release it
+        # now rather than keeping both alive until the response is sent
+        await file.close()
         
         # Perform OCR with operation and get annotated image
-        result, annotated_image = await ocr_service.perform_ocr_with_annotations(image, operation.strip())
+        result, annotated_image = await ocr_service.perform_ocr_with_annotations(
+            image, operation.strip(), image_digest
+        )
         
         # Prepare response
         response_data = {
@@ -76,9 +121,9 @@ async def process_ocr(
         
         # Convert annotated image to base64 if available
         if annotated_image:
-            buffered = BytesIO()
-            annotated_image.save(buffered, format="PNG")
-            img_str = base64.b64encode(buffered.getvalue()).decode()
+            img_str = await loop.run_in_executor(
+                None, encode_image_base64, annotated_image, "PNG"
+            )
             response_data["annotated_image"] = f"data:image/png;base64,{img_str}"
         
         return JSONResponse(content=response_data)
@@ -87,9 +132,26 @@ async def process_ocr(
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Processing error: {str(e)}")
+    finally:
+        # Release pixel storage now instead of waiting for garbage collection
+        if annotated_image is not None and annotated_image is not image:
+            annotated_image.close()
+        if image is not None:
+            image.close()
 
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # Multiple workers need an import string. "auto" picks uvloop and
+    # httptools when uvicorn[standard] installed them, and falls back to
+    # asyncio/h11 on platforms without them (Windows, PyPy).
+    # Each worker holds its own Ollama pool and OCR cache.
+    uvicorn.run(
+        "app.main:app",
+        host="0.0.0.0",
+        port=8000,
+        workers=int(os.getenv("WEB_CONCURRENCY", "4")),
+        loop="auto",
+        http="auto",
+    )
 
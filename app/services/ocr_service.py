@@ -1,45 +1,165 @@
 import os
+import asyncio
 import base64
+import functools
+import itertools
+import logging
 import re
+from collections import OrderedDict, defaultdict
 from io import BytesIO
 from typing import Optional, List, Dict
+import httpx
+import numpy as np
 from PIL import Image, ImageDraw, ImageFont
 from langchain_ollama import ChatOllama
 from langchain_core.messages import HumanMessage
 
+logger = logging.getLogger(__name__)
+
+# Image modes that can be sent as JPEG without losing information the model needs
+_JPEG_MODES = ("RGB", "L", "CMYK")
+
+# Longest side sent to the model; it rescales inputs to a fixed grid anyway,
+# so anything larger only costs encode time, bytes and vision-encoder work
+_MAX_IMAGE_DIM = 1280
+
+# Seconds to wait for the startup warmup before giving up on it
+_WARMUP_TIMEOUT = 300
+
+# Match ref and det pairs: <|ref|>name<|/ref|><|det|>[[coords]]<|/det|>
+_REF_DET_RE = re.compile(r'<\|ref\|>(.*?)<\|/?ref\|><\|det\|>\[(.*?)\]<\|/?det\|>', re.DOTALL)
+# Match a single [x1, y1, x2, y2] bounding box
+_BOX_RE = re.compile(r'\[\s*(\d+)\s*,\s*(\d+)\s*,\s*(\d+)\s*,\s*(\d+)\s*\]')
+
+# Colors for different object types
+_BOX_COLORS = (
+    (102, 126, 234),  # #667eea
+    (240, 147, 251),  # #f093fb
+    (79, 172, 254),   # #4facfe
+    (67, 233, 123),   # #43e97b
+    (250, 112, 154),  # #fa709a
+    (254, 225, 64),   # #fee140
+    (48, 207, 208),   # #30cfd0
+    (168, 237, 234),  # #a8edea
+)
+
+
+def encode_image_base64(image: Image.Image, image_format: str, **params) -> str:
+    """Encode a PIL Image in the given format and return it as a base64 string."""
+    with BytesIO() as buffered:
+        image.save(buffered, format=image_format, **params)
+        # Encode straight from the buffer's memory rather than a getvalue() copy;
+        # the view must be released before the buffer can close
+        with buffered.getbuffer() as view:
+            return base64.b64encode(view).decode("ascii")
+
+
+class _EncodeAbandoned(Exception):
+    """The caller encoding a shared request went away before handing it off."""
+
+
+def _load_font():
+    """Load the label font, falling back to PIL's default if none is available."""
+    try:
+        return ImageFont.truetype("/System/Library/Fonts/Helvetica.ttc", 16)
+    except OSError:
+        try:
+            return ImageFont.truetype("arial.ttf", 16)
+        except OSError:
+            return ImageFont.load_default()
+
+
+def _parse_keep_alive(value: str):
+    """Return keep_alive as seconds when numeric, else as a duration string like '30m'."""
+    try:
+        return int(value)
+    except ValueError:
+        return value
+
 
 class OCRService:
     def __init__(self):
         self.base_url = os.getenv("OLLAMA_BASE_URL", "http://localhost:11434")
         self.model_name = "deepseek-ocr"
+        self.num_ctx = 8000
+        # A negative keep_alive keeps the model loaded indefinitely, so idle
+        # periods don't trigger a multi-GB model reload on the next request
+        self.keep_alive = _parse_keep_alive(os.getenv("OLLAMA_KEEP_ALIVE", "-1"))
         self.llm = ChatOllama(
             model=self.model_name,
             base_url=self.base_url,
-            num_ctx=8000,
+            num_ctx=self.num_ctx,
+            keep_alive=self.keep_alive,
+            # Keep a bounded pool of keep-alive connections to Ollama so every
+            # request reuses an open socket instead of reconnecting
+            client_kwargs={
+                "limits": httpx.Limits(
+                    max_connections=32,
+                    max_keepalive_connections=16,
+                    keepalive_expiry=300,
+                ),
+            },
         )
+        # Font loading hits the filesystem, so do it once rather than per image
+        self._font = _load_font()
+        # LRU cache of model output keyed by (image digest, operation), so
+        # retries and repeated uploads don't re-run inference
+        self._cache_size = int(os.getenv("OCR_CACHE_SIZE", "256"))
+        self._result_cache: OrderedDict[tuple[str, str], str] = OrderedDict()
+        # Pending results per cache key; concurrent identical requests await
+        # the same future instead of each invoking the model
+        self._inflight: Dict[tuple[str, str], asyncio.Future] = {}
+        # Strong references to the shared model-call tasks, since the event
+        # loop only keeps weak ones
+        self._model_tasks: set[asyncio.Task] = set()
 
+    async def warmup(self) -> None:
+        """Open a pooled connection and load the model before the first request arrives."""
+        # A one-token request loads the model; the copy shares self.llm's
+        # client and keeps num_ctx, so Ollama doesn't reload for real requests
+        warmup_llm = self.llm.model_copy(update={"num_predict": 1})
+        try:
+            await asyncio.wait_for(
+                warmup_llm.ainvoke([HumanMessage(content="Hi")]),
+                timeout=_WARMUP_TIMEOUT,
+            )
+        except Exception as e:
+            logger.warning("Ollama warmup failed: %s", e)
+
+    def _model_image_size(self, size: tuple[int, int]) -> tuple[int, int]:
+        """Return the size an image of the given size is sent to the model at."""
+        width, height = size
+        longest = max(width, height)
+        if longest <= _MAX_IMAGE_DIM:
+            return size
+        scale = _MAX_IMAGE_DIM / longest
+        return (max(1, round(width * scale)), max(1, round(height * scale)))
+    
+    def _downscale_for_model(self, image: Image.Image) -> Image.Image:
+        """Return the image shrunk to fit _MAX_IMAGE_DIM, or unchanged if it already fits."""
+        size = self._model_image_size(image.size)
+        if size == image.size:
+            return image
+        return image.resize(size, Image.Resampling.LANCZOS, reducing_gap=3.0)
+    
     def _image_to_base64(self, image: Image.Image) -> str:
         """Convert PIL Image to base64 string."""
-        buffered = BytesIO()
-        image.save(buffered, format="PNG")
-        img_str = base64.b64encode(buffered.getvalue()).decode()
-        return img_str
+        # JPEG encodes far faster than PNG and produces a much smaller payload
+        # for photos; keep PNG for modes JPEG can't represent (alpha, palette)
+        if image.mode in _JPEG_MODES:
+            return encode_image_base64(image, "JPEG", quality=90, optimize=False)
+        return encode_image_base64(image, "PNG")
 
     def _parse_detections(self, text: str) -> List[Dict]:
         """Parse detection tags from OCR response."""
         detections = []
         
-        # Match ref and det pairs: <|ref|>name<|/ref|><|det|>[[coords]]<|/det|>
-        ref_det_regex = r'<\|ref\|>(.*?)<\|/?ref\|><\|det\|>\[(.*?)\]<\|/?det\|>'
-        
-        for match in re.finditer(ref_det_regex, text, re.DOTALL):
+        for match in _REF_DET_RE.finditer(text):
             object_name = match.group(1).strip()
             coords_string = match.group(2).strip()
             
             # Parse all bounding boxes from the coordinates string
-            box_regex = r'\[\s*(\d+)\s*,\s*(\d+)\s*,\s*(\d+)\s*,\s*(\d+)\s*\]'
-            
-            for box_match in re.finditer(box_regex, coords_string):
+            for box_match in _BOX_RE.finditer(coords_string):
                 detections.append({
                     'name': object_name,
                     'x1': int(box_match.group(1)),
@@ -50,95 +170,83 @@ class OCRService:
         
         return detections
     
-    def _draw_bounding_boxes(self, image: Image.Image, detections: List[Dict]) -> Image.Image:
-        """Draw bounding boxes and labels on the image."""
+    def _draw_bounding_boxes(
+        self,
+        image: Image.Image,
+        detections: List[Dict],
+        copy: bool = True,
+        model_size: Optional[tuple[int, int]] = None,
+    ) -> Image.Image:
+        """
+        Draw bounding boxes and labels on the image.
+        
+        With copy=False an RGB image is drawn on in place, saving a full pixel
+        buffer when the caller doesn't need the original afterwards.
+        model_size is the size of the image the model saw, if it was resized;
+        absolute pixel coordinates are scaled from it to this image's size.
+        """
         if not detections:
             return image
         
-        # Convert to RGB mode if necessary (PIL ImageDraw requires RGB)
+        # Convert to RGB mode if necessary (PIL ImageDraw requires RGB);
+        # convert() already returns a new image
         if image.mode != 'RGB':
             annotated_image = image.convert('RGB')
-        else:
+        elif copy:
             annotated_image = image.copy()
+        else:
+            annotated_image = image
         
         # Log image dimensions for debugging
         img_width, img_height = annotated_image.size
-        print(f"[DEBUG] Image dimensions: {img_width}x{img_height}")
-        print(f"[DEBUG] Number of detections: {len(detections)}")
+        logger.debug("Image dimensions: %dx%d", img_width, img_height)
+        logger.debug("Number of detections: %d", len(detections))
+        
+        # float64 so out-of-range coordinates from the model are clipped
+        # below instead of overflowing a fixed-width integer array
+        boxes = np.array(
+            [[det['x1'], det['y1'], det['x2'], det['y2']] for det in detections],
+            dtype=np.float64,
+        )
         
         # Check if coordinates are normalized (0-999 range)
         # If all coordinates are <= 999, assume they're normalized to 1000x1000 grid
-        max_coord = max(
-            max(det['x1'], det['x2'], det['y1'], det['y2'])
-            for det in detections
-        ) if detections else 0
-        
-        is_normalized = max_coord <= 999
+        is_normalized = boxes.max() <= 999
         
         if is_normalized:
-            print(f"[DEBUG] Coordinates appear to be normalized (0-999), scaling to image size")
+            logger.debug("Coordinates appear to be normalized (0-999), scaling to image size")
             # Scale factor from 1000x1000 grid to actual image size
             scale_x = img_width / 1000.0
             scale_y = img_height / 1000.0
         else:
-            print(f"[DEBUG] Coordinates appear to be absolute pixel coordinates")
-            scale_x = 1.0
-            scale_y = 1.0
+            logger.debug("Coordinates appear to be absolute pixel coordinates")
+            # Absolute coordinates are in the model input's pixel space
+            model_width, model_height = model_size or (img_width, img_height)
+            scale_x = img_width / model_width
+            scale_y = img_height / model_height
+        
+        # Calculate all box coordinates at once: order each box's corners,
+        # scale if normalized, round and clip to the image bounds
+        corners = boxes.reshape(-1, 2, 2)
+        corners = np.stack((corners.min(axis=1), corners.max(axis=1)), axis=1)
+        corners = np.round(corners * (scale_x, scale_y))
+        np.clip(corners, 0, (img_width - 1, img_height - 1), out=corners)
+        scaled_boxes = corners.astype(np.int32).reshape(-1, 4).tolist()
         
         draw = ImageDraw.Draw(annotated_image)
+        font = self._font
         
-        # Colors for different object types
-        colors = [
-            (102, 126, 234),  # #667eea
-            (240, 147, 251),  # #f093fb
-            (79, 172, 254),   # #4facfe
-            (67, 233, 123),   # #43e97b
-            (250, 112, 154),  # #fa709a
-            (254, 225, 64),   # #fee140
-            (48, 207, 208),   # #30cfd0
-            (168, 237, 234),  # #a8edea
-        ]
-        
-        # Map object names to colors
-        object_colors = {}
-        color_index = 0
-        
-        # Try to load a font, fall back to default if not available
-        try:
-            font = ImageFont.truetype("/System/Library/Fonts/Helvetica.ttc", 16)
-        except:
-            try:
-                font = ImageFont.truetype("arial.ttf", 16)
-            except:
-                font = ImageFont.load_default()
-        
-        for det in detections:
-            # Get or assign color for this object type
-            if det['name'] not in object_colors:
-                object_colors[det['name']] = colors[color_index % len(colors)]
-                color_index += 1
-            
+        # Map object names to colors, assigning the next color on first sight
+        color_cycle = itertools.cycle(_BOX_COLORS)
+        object_colors = defaultdict(lambda: next(color_cycle))
+        
+        for det, (x1, y1, x2, y2) in zip(detections, scaled_boxes):
             box_color = object_colors[det['name']]
             
-            # Calculate box coordinates (scale if normalized)
-            x1 = min(det['x1'], det['x2']) * scale_x
-            y1 = min(det['y1'], det['y2']) * scale_y
-            x2 = max(det['x1'], det['x2']) * scale_x
-            y2 = max(det['y1'], det['y2']) * scale_y
-            
-            # Convert to integers for drawing
-            x1 = int(round(x1))
-            y1 = int(round(y1))
-            x2 = int(round(x2))
-            y2 = int(round(y2))
-            
-            # Validate coordinates are within image bounds
-            x1 = max(0, min(x1, img_width - 1))
-            y1 = max(0, min(y1, img_height - 1))
-            x2 = max(0, min(x2, img_width - 1))
-            y2 = max(0, min(y2, img_height - 1))
-            
-            print(f"[DEBUG] Drawing box for '{det['name']}': original=({det['x1']}, {det['y1']}, {det['x2']}, {det['y2']}), scaled=({x1}, {y1}) to ({x2}, {y2})")
+            logger.debug(
+                "Drawing box for '%s': original=(%d, %d, %d, %d), scaled=(%d, %d) to (%d, %d)",
+                det['name'], det['x1'], det['y1'], det['x2'], det['y2'], x1, y1, x2, y2,
+            )
             
             # Draw bounding box
             draw.rectangle([x1, y1, x2, y2], outline=box_color, width=2)
@@ -167,12 +275,98 @@ class OCRService:
         
         return annotated_image
     
-    async def perform_ocr(self, image: Image.Image, operation: str) -> str:
-        """Perform OCR on an image using deepseek-ocr model with the given operation."""
-        try:
-            # Convert image to base64
-            img_base64 = self._image_to_base64(image)
+    def _get_cached_result(self, key: tuple[str, str]) -> Optional[str]:
+        """Return a cached OCR result and mark it as recently used."""
+        result = self._result_cache.get(key)
+        if result is not None:
+            self._result_cache.move_to_end(key)
+        return result
+    
+    def _cache_result(self, key: tuple[str, str], result: str) -> None:
+        """Store an OCR result, evicting the least recently used entries."""
+        if self._cache_size <= 0:
+            return
+        self._result_cache[key] = result
+        self._result_cache.move_to_end(key)
+        while len(self._result_cache) > self._cache_size:
+            self._result_cache.popitem(last=False)
+    
+    def _on_model_task_done(self, key: tuple[str, str], pending: asyncio.Future, task: asyncio.Task) -> None:
+        """Hand a finished model call's outcome to its waiters and cache successes."""
+        self._model_tasks.discard(task)
+        if self._inflight.get(key) is pending:
+            del self._inflight[key]
+        if task.cancelled():
+            pending.cancel()
+        elif task.exception() is not None:
+            pending.set_exception(task.exception())
+        else:
+            self._cache_result(key, task.result())
+            pending.set_result(task.result())
+    
+    async def perform_ocr(self, image: Image.Image, operation: str, image_digest: Optional[str] = None) -> str:
+        """
+        Perform OCR on an image using deepseek-ocr model with the given operation.
+        
+        If image_digest (a hash of the uploaded bytes) is given, results are
+        cached per (image_digest, operation) and concurrent identical requests
+        share a single model call.
+        """
+        if not image_digest:
+            return await self._invoke_model(await self._encode_for_model(image), operation)
+        
+        cache_key = (image_digest, operation)
+        while True:
+            cached = self._get_cached_result(cache_key)
+            if cached is not None:
+                return cached
             
+            pending = self._inflight.get(cache_key)
+            if pending is None:
+                return await self._start_shared_ocr(cache_key, image, operation)
+            try:
+                # Shield so one caller disconnecting doesn't cancel the call for the rest
+                return await asyncio.shield(pending)
+            except _EncodeAbandoned:
+                # The caller that was encoding its copy of the image failed or
+                # went away before the model call started; retry with ours
+                continue
+    
+    async def _start_shared_ocr(self, key: tuple[str, str], image: Image.Image, operation: str) -> str:
+        """Encode this caller's image and start the model call other callers can join."""
+        pending = asyncio.get_running_loop().create_future()
+        # Mark the outcome as retrieved even if no other caller joins
+        pending.add_done_callback(lambda f: f.cancelled() or f.exception())
+        # Register before encoding so identical requests arriving meanwhile join
+        self._inflight[key] = pending
+        try:
+            # The image belongs to this caller and is closed when its request
+            # ends, so the shared task only ever sees the encoded string
+            img_base64 = await self._encode_for_model(image)
+        except BaseException:
+            del self._inflight[key]
+            pending.set_exception(_EncodeAbandoned())
+            raise
+        
+        task = asyncio.create_task(self._invoke_model(img_base64, operation))
+        self._model_tasks.add(task)
+        task.add_done_callback(lambda t: self._on_model_task_done(key, pending, t))
+        # Shield so one caller disconnecting doesn't cancel the call for the rest
+        return await asyncio.shield(pending)
+    
+    async def _encode_for_model(self, image: Image.Image) -> str:
+        """Downscale and convert the image to base64 off the event loop."""
+        try:
+            # The caller keeps the full-size image for annotation
+            return await asyncio.get_running_loop().run_in_executor(
+                None, lambda: self._image_to_base64(self._downscale_for_model(image))
+            )
+        except Exception as e:
+            raise Exception(f"OCR failed: {str(e)}")
+    
+    async def _invoke_model(self, img_base64: str, operation: str) -> str:
+        """Send the encoded image and operation to the model and return its response text."""
+        try:
             # Create message with image and operation text
             message = HumanMessage(
                 content=[
@@ -180,11 +374,12 @@ class OCRService:
                         "type": "text",
                         "text": operation
                     },
+                    # Pass the bare base64 string: Ollama only accepts base64
+                    # images, and langchain-ollama would otherwise split the
+                    # payload back out of a data URL, copying it twice more
                     {
                         "type": "image_url",
-                        "image_url": {
-                            "url": f"data:image/png;base64,{img_base64}"
-                        }
+                        "image_url": img_base64
                     }
                 ]
             )
@@ -195,13 +390,27 @@ class OCRService:
         except Exception as e:
             raise Exception(f"OCR failed: {str(e)}")
     
-    async def perform_ocr_with_annotations(self, image: Image.Image, operation: str) -> tuple[str, Optional[Image.Image]]:
+    async def perform_ocr_with_annotations(self, image: Image.Image, operation: str, image_digest: Optional[str] = None) -> tuple[str, Optional[Image.Image]]:
         """Perform OCR and return annotated image if detections are found."""
-        ocr_result = await self.perform_ocr(image, operation)
+        ocr_result = await self.perform_ocr(image, operation, image_digest)
+        # Plain OCR and description prompts never emit detection tags, so skip
+        # the regex scan when a cheap substring check finds none
+        if '<|det|>' not in ocr_result:
+            return ocr_result, None
         detections = self._parse_detections(ocr_result)
         
         annotated_image = None
         if detections:
-            annotated_image = self._draw_bounding_boxes(image, detections)
+            # The caller discards the original once annotated, so draw in place
+            annotated_image = await asyncio.get_running_loop().run_in_executor(
+                None,
+                functools.partial(
+                    self._draw_bounding_boxes,
+                    image,
+                    detections,
+                    copy=False,
+                    model_size=self._model_image_size(image.size),
+                ),
+            )
         
         return ocr_result, annotated_image